@@ -1,10 +1,24 @@
 import os
+import io
+import errno
 import re
 import sqlite3
 import logging
 import shutil
-from datetime import datetime
-from flask import Flask, request, jsonify, send_file, abort, render_template, g
+import stat
+import mmap
+import queue
+import atexit
+import concurrent.futures
+import threading
+import time
+import hashlib
+import functools
+import itertools
+from collections import OrderedDict
+from urllib.parse import quote
+from datetime import datetime, timedelta
+from flask import Flask, request, jsonify, send_file, abort, render_template, g, url_for
 from werkzeug.utils import secure_filename
 from flask_cors import CORS
 import requests
@@ -14,7 +28,35 @@ UPLOAD_FOLDER = "uploads"
 DB_FILE = "data.db"
 ALLOWED_EXTENSIONS = {"prn"}
 ALLOWED_STAGES = {"Raw", "SFG", "FG"}
+# display order for per-stage output; set iteration order varies with each process's hash seed
+STAGE_ORDER = ("Raw", "SFG", "FG")
 MAX_CONTENT_LENGTH = 5 * 1024 * 1024
+DB_POOL_SIZE = 8
+PREVIEW_WORKERS = 4
+PREVIEW_CACHE_SIZE = 256
+# browsers revalidate previews by ETag after this; kept short because a deleted PRN's filename can be reused
+PREVIEW_MAX_AGE = 300
+PRODUCT_ID_CACHE_SIZE = 1024
+WAL_CHECKPOINT_INTERVAL = 300  # seconds between background wal_checkpoint(TRUNCATE) runs
+# hand file bodies to the front-end proxy instead of streaming them from Python:
+# None (send_file), "x-sendfile" (Apache/lighttpd) or "x-accel" (nginx, with UPLOAD_FOLDER
+# aliased under X_ACCEL_PREFIX as an internal location)
+SENDFILE_MODE = None
+X_ACCEL_PREFIX = "/_prn/"
+# one-shot downloads at least this large are dropped from the page cache once sent
+FADVISE_DONTNEED_MIN = 1024 * 1024
+
+# {FIELD} placeholders inside PRN templates (matched on raw bytes); the group captures the bare field name
+_PLACEHOLDER_RE_B = re.compile(rb"\{([A-Za-z0-9_]+)\}")
+# any {...} token; used when matching against user-defined variable names, which may
+# contain characters the strict placeholder pattern does not accept
+_BRACED_TOKEN_RE = re.compile(r"\{([^{}]+)\}")
+
+# statements issued from more than one handler; sharing the exact text shares the prepared
+# statement in each connection's statement cache
+_SQL_INSERT_PRN = "INSERT INTO product_prns (product_id, stage, prn_filename, prn_path) VALUES (?, ?, ?, ?)"
+_SQL_FIND_VARIABLE = "SELECT id FROM variables WHERE product_id = ? AND stage = ? AND field_name = ?"
+_SQL_VARIABLE_VALUES = "SELECT field_name, field_value FROM variables WHERE product_id = ? AND stage = ?"
 
 
 LABELARY_PRINTER = "8dpmm"
@@ -22,11 +64,23 @@ LABELARY_LABEL = "4x6"
 LABELARY_ROTATION = "0"
 LABELARY_URL = f"http://api.labelary.com/v1/printers/{LABELARY_PRINTER}/labels/{LABELARY_LABEL}/{LABELARY_ROTATION}/"
 
+# shared session so previews reuse a keep-alive connection to Labelary
+_labelary_session = requests.Session()
+# previews are rendered off the request path; the pool size also caps concurrent calls to Labelary
+_preview_pool = concurrent.futures.ThreadPoolExecutor(max_workers=PREVIEW_WORKERS, thread_name_prefix="preview")
+# (content digest, printer, label, rotation) -> (path, st_size, st_mtime_ns) of a PNG already rendered
+# for that content, LRU ordered; the stat pair detects a PNG replaced since it was cached
+_preview_cache = OrderedDict()
+_preview_cache_lock = threading.Lock()
+
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 app = Flask(__name__, static_folder="static", template_folder="templates")
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 app.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH
+app.config["USE_X_SENDFILE"] = SENDFILE_MODE is not None
+# responses are built in a fixed order already; skip re-sorting every dict's keys when encoding
+app.json.sort_keys = False
 CORS(app)
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
@@ -42,6 +96,80 @@ def jsonify_error(msg, code=400, details=None):
     return response
 
 
+# O_NOFOLLOW refuses a symlink planted under uploads; O_BINARY matters on Windows, where fds default to text mode
+_SEND_OPEN_FLAGS = os.O_RDONLY | getattr(os, "O_NOFOLLOW", 0) | getattr(os, "O_CLOEXEC", 0) | getattr(os, "O_BINARY", 0)
+
+
+class _EvictOnClose(io.FileIO):
+    """Read-only file that asks the kernel to drop its cached pages once it has been sent."""
+
+    def close(self):
+        if not self.closed:
+            try:
+                os.posix_fadvise(self.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            except OSError:
+                pass
+        super().close()
+
+
+def send_upload(path, one_shot=False, **kwargs):
+    """send_file for a file under UPLOAD_FOLDER; the proxy sends the body when SENDFILE_MODE is set.
+    Raises FileNotFoundError if the file is gone, so callers need no separate exists() check.
+    one_shot marks downloads unlikely to be read again (PRNs, unlike previews): large ones are
+    evicted from the page cache afterwards so they do not push hot previews out.
+    """
+    if SENDFILE_MODE is not None:
+        # send_file resolves relative paths against app.root_path, but uploads are written relative to the CWD
+        abs_path = os.path.abspath(path)
+        response = send_file(abs_path, **kwargs)
+        if SENDFILE_MODE == "x-accel":
+            # Flask emitted X-Sendfile with the absolute path; nginx wants a URI in its internal location
+            del response.headers["X-Sendfile"]
+            rel_path = os.path.relpath(abs_path, os.path.abspath(UPLOAD_FOLDER)).replace(os.sep, "/")
+            response.headers["X-Accel-Redirect"] = X_ACCEL_PREFIX + quote(rel_path)
+        return response
+
+    # a single open(); the metadata send_file would stat the path for comes from the fd instead
+    try:
+        fd = os.open(path, _SEND_OPEN_FLAGS)
+    except OSError as e:
+        if e.errno == errno.ELOOP:
+            # a symlink where an upload should be is served as missing, not followed
+            raise FileNotFoundError(errno.ENOENT, "upload is a symlink", path) from e
+        raise
+    fadvise = hasattr(os, "posix_fadvise")
+    try:
+        st_result = os.fstat(fd)
+        if not stat.S_ISREG(st_result.st_mode):
+            # e.g. /download/<product folder>: only regular files are served
+            raise FileNotFoundError(errno.ENOENT, "upload is not a regular file", path)
+        # send_file responses bypass call_on_close, so eviction hooks the file's own close()
+        if fadvise and one_shot and st_result.st_size >= FADVISE_DONTNEED_MIN:
+            f = _EvictOnClose(fd, "rb")
+        else:
+            f = os.fdopen(fd, "rb")
+    except BaseException:
+        os.close(fd)
+        raise
+    try:
+        if fadvise:
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                pass
+        kwargs.setdefault("download_name", os.path.basename(path))
+        kwargs.setdefault("etag", f"{st_result.st_size:x}-{st_result.st_mtime_ns:x}")
+        kwargs.setdefault("last_modified", st_result.st_mtime)
+        response = send_file(f, conditional=False, **kwargs)
+        # send_file cannot size a file object, so the length from fstat is set here, before the
+        # Range/If-None-Match handling that send_file would otherwise have done
+        response.content_length = st_result.st_size
+        return response.make_conditional(request.environ, accept_ranges=True, complete_length=st_result.st_size)
+    except BaseException:
+        f.close()
+        raise
+
+
 def allowed_file(filename: str) -> bool:
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
@@ -54,34 +182,71 @@ def allowed_file(filename: str) -> bool:
 #     safe_filename = secure_filename(filename)
 #     return os.path.join(app.config["UPLOAD_FOLDER"], safe_product, safe_stage, safe_filename)
 
+# lower-cased stage spellings accepted from clients -> canonical stage
+_STAGE_ALIASES = {a: "Raw" for a in ("raw", "rawmaterial", "raw_material", "raw material")}
+_STAGE_ALIASES.update({a: "SFG" for a in ("sfg", "semi", "semi_finished", "semi_finished_good", "semi finished", "semi-finished", "semifinished")})
+_STAGE_ALIASES.update({a: "FG" for a in ("fg", "finished", "finished_good", "finished good", "finished-good")})
+
+
 def stage_folder_name(stage_raw: str):
     if not stage_raw:
         return None
-    s = stage_raw.strip().lower()
-    if s in ("raw", "rawmaterial", "raw_material", "raw material"):
-        return "Raw"
-    if s in ("sfg", "semi", "semi_finished", "semi_finished_good", "semi finished", "semi-finished", "semifinished"):
-        return "SFG"
-    if s in ("fg", "finished", "finished_good", "finished good", "finished-good"):
-        return "FG"
     # allow canonical forms as well
-    if stage_raw in ALLOWED_STAGES:
-        return stage_raw
-    return None
+    return _STAGE_ALIASES.get(stage_raw.strip().lower()) or (stage_raw if stage_raw in ALLOWED_STAGES else None)
+
+
+def _placeholders_in(buf):
+    # placeholders are pure ASCII, so bytes-like buffers are scanned directly without decoding
+    return sorted({m.group(1).decode("ascii") for m in _PLACEHOLDER_RE_B.finditer(buf)})
 
 
 def extract_prn_columns(file_path: str):
     """Return sorted unique {PLACEHOLDER} fields found in a PRN file."""
-    try:
-        with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-            text = f.read()
-    except Exception:
-        raise
-    matches = re.findall(r"\{[A-Za-z0-9_]+\}", text)
-    unique_fields = sorted(set(m.strip("{}") for m in matches))
-    return unique_fields
+    with open(file_path, "rb") as f:
+        # mmap refuses empty files
+        if os.fstat(f.fileno()).st_size == 0:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return _placeholders_in(mm)
 
 
+def save_upload(upload, save_path: str):
+    """
+    Write an uploaded PRN to save_path and return its placeholder fields.
+    Uploads still held in memory are written and scanned from the same buffer; uploads Werkzeug
+    spooled to a temp file are copied in-kernel and scanned from the page cache.
+    """
+    stream = upload.stream
+    if isinstance(stream, io.BytesIO) or getattr(stream, "_rolled", True) is False:
+        stream.seek(0)
+        data = stream.read()
+        with open(save_path, "wb") as dst:
+            dst.write(data)
+        return _placeholders_in(data)
+
+    with open(save_path, "wb") as dst:
+        try:
+            src_fd = stream.fileno()
+            offset = 0
+            while True:
+                copied = os.copy_file_range(src_fd, dst.fileno(), 1 << 20, offset)
+                if not copied:
+                    break
+                offset += copied
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            # no copy_file_range (non-Linux) or not fd-backed: plain copy with a 1 MB buffer
+            stream.seek(0)
+            dst.seek(0)
+            dst.truncate()
+            shutil.copyfileobj(stream, dst, 1 << 20)
+    return extract_prn_columns(save_path)
+
+
+# the same PRN names arrive on every get-prn/preview/delete request; secure_filename is pure
+_secure_filename = functools.lru_cache(maxsize=8192)(secure_filename)
+
+
+@functools.lru_cache(maxsize=2048)
 def normalize_product_folder_name(product_name: str) -> str:
     if not product_name:
         return ""
@@ -91,35 +256,240 @@ def normalize_product_folder_name(product_name: str) -> str:
     return re.sub(r"[^\w\-\_\. ]", "_", product_name).strip()
 
 
+@functools.lru_cache(maxsize=2048)
+def _product_dir(product_name: str, stage: str) -> str:
+    """Upload folder for a product + canonical stage (UPLOAD_FOLDER is fixed at startup)."""
+    return os.path.join(app.config["UPLOAD_FOLDER"], normalize_product_folder_name(product_name), stage)
+
+
+# process-wide counter appended to time_ns() so generated filenames never collide within a process
+_uniq = itertools.count()
+
+
+def _unique_suffix(now_ns=None) -> str:
+    """Filename suffix; pass now_ns when the caller also needs the same timestamp for something else."""
+    return f"{now_ns or time.time_ns()}_{next(_uniq)}"
+
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _utc_isoformat(now_ns: int) -> str:
+    """Naive-UTC ISO timestamp (the format datetime.utcnow().isoformat() gave) from a time_ns() value."""
+    return (_EPOCH + timedelta(microseconds=now_ns // 1000)).isoformat()
+
+
+# folders this process has already created, so repeat uploads skip the mkdir/stat
+_ensured_dirs = set()
+
+
+def _ensure_dir(path: str, force: bool = False):
+    if force or path not in _ensured_dirs:
+        os.makedirs(path, exist_ok=True)
+        _ensured_dirs.add(path)
+
+
+def _forget_cached_preview(cache_key, entry):
+    with _preview_cache_lock:
+        if _preview_cache.get(cache_key) == entry:
+            del _preview_cache[cache_key]
+
+
+def _copy_cached_preview(cache_key, out_path: str) -> bool:
+    """Copy a previously rendered PNG for the same PRN content to out_path, if it is still on disk unchanged."""
+    with _preview_cache_lock:
+        entry = _preview_cache.get(cache_key)
+        if entry is None:
+            return False
+        _preview_cache.move_to_end(cache_key)
+    cached, size, mtime_ns = entry
+    try:
+        with open(cached, "rb") as src:
+            # the PNG may have been deleted or overwritten since (e.g. delete-prn and a re-upload
+            # under the same name, possibly in another worker process); only trust it if unchanged
+            st_result = os.fstat(src.fileno())
+            if (st_result.st_size, st_result.st_mtime_ns) != (size, mtime_ns):
+                _forget_cached_preview(cache_key, entry)
+                return False
+            if cached == out_path:
+                return True
+            with open(out_path + ".tmp", "wb") as dst:
+                shutil.copyfileobj(src, dst, 65536)
+        os.replace(out_path + ".tmp", out_path)
+        return True
+    except OSError:
+        # the cached preview is gone; forget it and render again
+        _forget_cached_preview(cache_key, entry)
+        try:
+            os.remove(out_path + ".tmp")
+        except OSError:
+            pass
+        return False
+
+
 def generate_preview(prn_path: str, out_path: str) -> bool:
     """
     Generate PNG preview using Labelary API. Returns True on success.
     This is best-effort (won't raise) and will return False on failure.
+    PRNs whose content was rendered before are served by copying the earlier PNG.
     """
     try:
         with open(prn_path, "rb") as f:
-            files = {"file": f}
-            resp = requests.post(LABELARY_URL, files=files, stream=True, timeout=30)
+            digest = hashlib.blake2b(digest_size=16)
+            for chunk in iter(lambda: f.read(65536), b""):
+                digest.update(chunk)
+            cache_key = (digest.digest(), LABELARY_PRINTER, LABELARY_LABEL, LABELARY_ROTATION)
+            if _copy_cached_preview(cache_key, out_path):
+                return True
+
+            f.seek(0)
+            # post the raw ZPL as the body (streamed from the file) instead of a multipart upload
+            resp = _labelary_session.post(
+                LABELARY_URL,
+                data=f,
+                headers={"Accept": "image/png", "Content-Type": "application/x-www-form-urlencoded"},
+                stream=True,
+                timeout=30,
+            )
+        with resp:
             if resp.status_code == 200:
                 resp.raw.decode_content = True
-                with open(out_path, "wb") as out_file:
-                    shutil.copyfileobj(resp.raw, out_file)
+                # write next to the target and rename, so out_path only ever holds a complete PNG
+                tmp_path = out_path + ".tmp"
+                with open(tmp_path, "wb") as out_file:
+                    shutil.copyfileobj(resp.raw, out_file, 65536)
+                os.replace(tmp_path, out_path)
+                st_result = os.stat(out_path)
+                with _preview_cache_lock:
+                    _preview_cache[cache_key] = (out_path, st_result.st_size, st_result.st_mtime_ns)
+                    _preview_cache.move_to_end(cache_key)
+                    if len(_preview_cache) > PREVIEW_CACHE_SIZE:
+                        _preview_cache.popitem(last=False)
                 return True
             else:
                 logger.warning("Labelary preview failed: %s %s", resp.status_code, resp.text[:200])
                 return False
     except Exception as e:
         logger.exception("Exception while generating label preview: %s", e)
+        try:
+            os.remove(out_path + ".tmp")
+        except OSError:
+            pass
         return False
 
 
-def _get_connection():
-    conn = sqlite3.connect(DB_FILE)
+# journal_mode=WAL is persistent in the database file, so it only needs to be set once
+_wal_enabled = False
+
+
+def _configure_connection(conn):
+    """Apply the row factory and per-connection PRAGMAs shared by every connection."""
+    global _wal_enabled
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA foreign_keys = ON")
+    if not _wal_enabled:
+        conn.execute("PRAGMA journal_mode = WAL")
+        _wal_enabled = True
+    # WAL + NORMAL only fsyncs at checkpoints instead of on every commit
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA cache_size = -20000")
+    conn.execute("PRAGMA mmap_size = 268435456")
+    conn.execute("PRAGMA wal_autocheckpoint = 1000")
     return conn
 
 
+# reusable connections; LIFO so the most recently used (warmest) connection is handed out first
+_POOL = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+
+def _get_connection():
+    """Check a connection out of the pool, opening a new one if the pool is empty."""
+    try:
+        return _POOL.get_nowait()
+    except queue.Empty:
+        # autocommit mode: write transactions are opened explicitly by _begin_write
+        return _configure_connection(sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None, cached_statements=256))
+
+
+def _release_connection(conn):
+    """Return a connection to the pool, or close it if the pool is already full."""
+    if conn.in_transaction:
+        conn.rollback()
+    try:
+        _POOL.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+
+@atexit.register
+def _close_pool():
+    while True:
+        try:
+            conn = _POOL.get_nowait()
+        except queue.Empty:
+            return
+        try:
+            # refresh planner statistics for the indexes this connection used
+            conn.execute("PRAGMA optimize")
+        except sqlite3.Error:
+            pass
+        conn.close()
+
+
+# serialises writers in this process, so they queue on a lock instead of polling in SQLite's busy handler
+_write_lock = threading.Lock()
+
+
+def _begin_write(conn):
+    """Open the request's write transaction on its first mutation; it is committed once in commit_db."""
+    _ensure_background_thread("wal-checkpoint", _checkpoint_loop)
+    if not conn.in_transaction:
+        _write_lock.acquire()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+        except BaseException:
+            _write_lock.release()
+            raise
+        g.holds_write_lock = True
+
+
+def _end_write():
+    """Release the write lock taken by _begin_write once the request's transaction has ended."""
+    if g.pop("holds_write_lock", False):
+        _write_lock.release()
+
+
+def _checkpoint_loop():
+    # commits under synchronous=NORMAL do not fsync; truncating the WAL periodically keeps it
+    # from growing between the automatic (passive) checkpoints
+    while True:
+        time.sleep(WAL_CHECKPOINT_INTERVAL)
+        conn = _get_connection()
+        try:
+            with _write_lock:
+                conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.Error:
+            logger.exception("WAL checkpoint failed")
+        finally:
+            _release_connection(conn)
+
+
+_background_threads = {}
+_background_threads_lock = threading.Lock()
+
+
+def _ensure_background_thread(name, target):
+    """Start a daemon thread once; started lazily so nothing is running yet if the app is imported and then forked."""
+    if name in _background_threads:
+        return
+    with _background_threads_lock:
+        if name not in _background_threads:
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            _background_threads[name] = thread
+
+
 def init_db():
     """Create / migrate schema if not exists."""
     conn = _get_connection()
@@ -163,10 +533,14 @@ def init_db():
         )
         """
     )
-    c.execute("CREATE INDEX IF NOT EXISTS idx_prns_product_stage ON product_prns(product_id, stage)")
+    # (product_id, stage) lookups use the prefix; ORDER BY uploaded_at DESC walks the index instead of sorting
+    c.execute("CREATE INDEX IF NOT EXISTS idx_prns_prod_stage_time ON product_prns(product_id, stage, uploaded_at DESC)")
+    c.execute("DROP INDEX IF EXISTS idx_prns_product_stage")
+    # /download looks PRNs up by bare filename
+    c.execute("CREATE INDEX IF NOT EXISTS idx_prns_filename ON product_prns(prn_filename)")
 
     conn.commit()
-    conn.close()
+    _release_connection(conn)
 
 
 def migrate_legacy_variables():
@@ -177,7 +551,7 @@ def migrate_legacy_variables():
     c = conn.cursor()
     c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='variables'")
     if not c.fetchone():
-        conn.close()
+        _release_connection(conn)
         return
 
     c.execute("PRAGMA table_info(variables)")
@@ -194,16 +568,13 @@ def migrate_legacy_variables():
             logger.info("Migration completed. Existing rows have empty stage; review them if you want to reassign stages.")
         except Exception as e:
             logger.exception("Failed to migrate variables table: %s", e)
-    conn.close()
+    _release_connection(conn)
 
 
 def get_db():
-    """Return a sqlite3 connection stored on flask.g, one per request."""
+    """Return a pooled sqlite3 connection stored on flask.g, one per request."""
     if "db" not in g:
-        conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-        conn.row_factory = sqlite3.Row
-        conn.execute("PRAGMA foreign_keys = ON")
-        g.db = conn
+        g.db = _get_connection()
     return g.db
 
 
@@ -211,7 +582,101 @@ def get_db():
 def close_db(exception=None):
     db = g.pop("db", None)
     if db is not None:
-        db.close()
+        _release_connection(db)
+    _end_write()
+
+
+@app.after_request
+def commit_db(response):
+    """Commit the request's write transaction, or roll it back if the handler returned an error."""
+    db = g.get("db")
+    committed = True
+    if db is not None and db.in_transaction:
+        try:
+            if response.status_code >= 400:
+                db.rollback()
+                committed = False
+            else:
+                try:
+                    db.commit()
+                except sqlite3.Error as e:
+                    logger.exception("Failed to commit request transaction")
+                    db.rollback()
+                    g.pop("pending_previews", None)
+                    g.pop("pending_unlinks", None)
+                    return jsonify_error("failed to save changes", 500, e)
+        finally:
+            _end_write()
+    # previews are only queued once the rows they update are visible to the worker
+    pending = g.pop("pending_previews", ())
+    unlinks = g.pop("pending_unlinks", ())
+    if committed:
+        for job in pending:
+            _enqueue_preview(*job)
+        for path in unlinks:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning("Error removing %s after commit: %s", path, e)
+    return response
+
+
+def _unlink_after_commit(path):
+    """Remove a file once the current request's transaction commits; kept if it rolls back."""
+    g.setdefault("pending_unlinks", []).append(path)
+
+
+def _record_preview(preview_path, product_id, stage, prn_filename):
+    """Set preview_path on a PRN row once its PNG is in place."""
+    conn = _get_connection()
+    try:
+        with _write_lock:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "UPDATE product_prns SET preview_path = ? WHERE product_id = ? AND stage = ? AND prn_filename = ?",
+                (preview_path, product_id, stage, prn_filename),
+            )
+            conn.commit()
+    except Exception:
+        logger.exception("Failed to update preview_path in DB after generating preview")
+    finally:
+        _release_connection(conn)
+
+
+def _render_preview(product_id, stage, prn_filename, prn_path, preview_path):
+    """Render one PRN's preview on the pool; content rendered before is copied from generate_preview's cache."""
+    # preview_path is only set once the PNG is in place, so readers can trust the column without
+    # checking the disk; rows are inserted with it NULL, so failed renders need no write at all
+    if generate_preview(prn_path, preview_path):
+        _record_preview(preview_path, product_id, stage, prn_filename)
+
+
+def _log_preview_failure(future):
+    if future.cancelled():
+        return
+    exc = future.exception()
+    if exc is not None:
+        logger.error("Preview rendering failed", exc_info=exc)
+
+
+def _schedule_preview(product_id, stage, prn_filename, prn_path):
+    """Queue preview generation for a PRN registered in the current request; it is released once the request commits."""
+    g.setdefault("pending_previews", []).append((product_id, stage, prn_filename, prn_path))
+
+
+def _enqueue_preview(product_id, stage, prn_filename, prn_path):
+    """Hand a committed PRN to the preview pool; the preview is served once it is ready."""
+    preview_path = os.path.join(os.path.dirname(prn_path), os.path.splitext(prn_filename)[0] + ".png")
+    # each job gets its own pool thread, so one slow or hung Labelary call never holds back the others
+    try:
+        future = _preview_pool.submit(_render_preview, product_id, stage, prn_filename, prn_path, preview_path)
+    except RuntimeError:
+        # the executor is shut down at interpreter exit
+        logger.warning("Dropping preview job for %s at shutdown", prn_path)
+        return
+    future.add_done_callback(_log_preview_failure)
 
 
 init_db()
@@ -234,6 +699,21 @@ def require_stage_from_request(req_data=None):
     return stage
 
 
+def require_json_fields(*keys):
+    """
+    Parse the request body as a JSON object and check the required keys in one pass.
+    Returns (data, missing): data is None unless the body is a JSON object,
+    missing is the first required key that is absent (or None).
+    """
+    data = request.get_json(force=True, silent=True)
+    if not isinstance(data, dict):
+        return None, None
+    for k in keys:
+        if k not in data:
+            return data, k
+    return data, None
+
+
 @app.route("/", methods=["GET"])
 def index():
     try:
@@ -242,11 +722,54 @@ def index():
         return "<h1>PRN Manager</h1><p>Frontend not found. Place your index.html in templates/</p>"
 
 
+# product_name -> id. Products are never deleted or renamed, so a cached id cannot go stale;
+# ids are only cached once read back from the table, never from an uncommitted insert.
+_product_ids = OrderedDict()
+_product_ids_lock = threading.Lock()
+
+
+def _get_product_id(cur, product_name):
+    """Return the id of an existing product, or None if it does not exist."""
+    with _product_ids_lock:
+        product_id = _product_ids.get(product_name)
+        if product_id is not None:
+            _product_ids.move_to_end(product_name)
+            return product_id
+    cur.execute("SELECT id FROM products WHERE product_name = ?", (product_name,))
+    row = cur.fetchone()
+    if not row:
+        return None
+    if cur.connection.in_transaction:
+        # may be this request's own uncommitted insert
+        return row["id"]
+    with _product_ids_lock:
+        _product_ids[product_name] = row["id"]
+        if len(_product_ids) > PRODUCT_ID_CACHE_SIZE:
+            _product_ids.popitem(last=False)
+    return row["id"]
+
+
+def _get_or_create_product(cur, product_name):
+    """Return the id of product_name, inserting it first if needed, in a single statement.
+    DO UPDATE (rather than DO NOTHING) makes RETURNING yield the id on the conflict path too.
+    """
+    with _product_ids_lock:
+        product_id = _product_ids.get(product_name)
+    if product_id is not None:
+        return product_id
+    cur.execute(
+        "INSERT INTO products (product_name) VALUES (?) "
+        "ON CONFLICT(product_name) DO UPDATE SET product_name = excluded.product_name RETURNING id",
+        (product_name,),
+    )
+    return cur.fetchone()["id"]
+
+
 @app.route("/create-product", methods=["POST"])
 def create_product():
     """Create or idempotently ensure a product exists."""
-    data = request.get_json(force=True, silent=True)
-    if not data or "product_name" not in data:
+    data, missing = require_json_fields("product_name")
+    if data is None or missing:
         return jsonify_error("product_name required", 400)
     pname = str(data["product_name"]).strip()
     if not pname:
@@ -255,26 +778,30 @@ def create_product():
     conn = get_db()
     cur = conn.cursor()
     try:
-        cur.execute("INSERT OR IGNORE INTO products (product_name) VALUES (?)", (pname,))
-        conn.commit()
-        cur.execute("SELECT id FROM products WHERE product_name = ?", (pname,))
-        row = cur.fetchone()
-        product_id = row["id"]
+        _begin_write(conn)
+        product_id = _get_or_create_product(cur, pname)
     except Exception as e:
         logger.exception("Error creating product")
         return jsonify_error("failed to create product", 500, e)
     return jsonify({"message": "product created or exists", "product_name": pname, "product_id": product_id})
 
 
-def _fill_prn_content(prn_content: str, variables: dict) -> str:
-    """Replace placeholders {FIELD} in prn_content with provided variable values.
+def _write_filled_prn(out, prn_content: str, variables: dict):
+    """Write prn_content to the text stream `out`, replacing placeholders {FIELD} with provided variable values.
     Only replaces exact placeholders matching the field name (case-sensitive).
     """
-    # Replace longer variable names first to avoid partial replacements
-    for k in sorted(variables.keys(), key=lambda x: -len(x)):
-        v = str(variables[k]) if variables[k] is not None else ""
-        prn_content = re.sub(r"\{" + re.escape(k) + r"\}", v, prn_content)
-    return prn_content
+    # single scan over the content; spans go straight to `out` so the filled PRN is never
+    # materialised as one string. Unknown {...} tokens are left untouched.
+    str_map = {k: ("" if v is None else str(v)) for k, v in variables.items()}
+    pos = 0
+    for m in _BRACED_TOKEN_RE.finditer(prn_content):
+        value = str_map.get(m.group(1))
+        if value is None:
+            continue
+        out.write(prn_content[pos:m.start()])
+        out.write(value)
+        pos = m.end()
+    out.write(prn_content[pos:])
 
 
 @app.route("/upload", methods=["POST"])
@@ -310,11 +837,10 @@ def upload_file():
         return jsonify_error("only .prn files allowed", 400)
 
     filename = secure_filename(file.filename)
-    safe_product = normalize_product_folder_name(product_name)
-    product_dir = os.path.join(app.config["UPLOAD_FOLDER"], safe_product, stage)
+    product_dir = _product_dir(product_name, stage)
 
     try:
-        os.makedirs(product_dir, exist_ok=True)
+        _ensure_dir(product_dir)
     except Exception as e:
         logger.exception("Failed to create folder for product uploads")
         return jsonify_error("failed to create product upload folder", 500, e)
@@ -322,49 +848,29 @@ def upload_file():
     save_path = os.path.join(product_dir, filename)
     if os.path.exists(save_path):
         base, ext = os.path.splitext(filename)
-        filename = f"{base}_{int(datetime.utcnow().timestamp())}{ext}"
+        filename = f"{base}_{_unique_suffix()}{ext}"
         save_path = os.path.join(product_dir, filename)
     try:
-        file.save(save_path)
+        try:
+            fields = save_upload(file, save_path)
+        except FileNotFoundError:
+            # the folder was removed since this process created it
+            _ensure_dir(product_dir, force=True)
+            fields = save_upload(file, save_path)
     except Exception as e:
         logger.exception("Error saving uploaded file")
         return jsonify_error("failed to save file", 500, e)
 
-    try:
-        fields = extract_prn_columns(save_path)
-    except Exception as e:
-        logger.exception("Error parsing PRN file")
-        return jsonify_error("failed to parse file", 500, e)
-
     conn = get_db()
     cur = conn.cursor()
     try:
-        cur.execute("INSERT OR IGNORE INTO products (product_name) VALUES (?)", (product_name,))
-        conn.commit()
-        cur.execute("SELECT id FROM products WHERE product_name = ?", (product_name,))
-        row = cur.fetchone()
-        if not row:
-            return jsonify_error("failed to create or fetch product", 500)
-        product_id = row["id"]
-
+        _begin_write(conn)
+        product_id = _get_or_create_product(cur, product_name)
         cur.execute(
-            "INSERT INTO product_prns (product_id, stage, prn_filename, prn_path) VALUES (?, ?, ?, ?)",
+            _SQL_INSERT_PRN,
             (product_id, stage, filename, save_path),
         )
-        conn.commit()
-
-        preview_fname = os.path.splitext(filename)[0] + ".png"
-        preview_full = os.path.join(product_dir, preview_fname)
-        preview_ok = generate_preview(save_path, preview_full)
-        if preview_ok:
-            try:
-                cur.execute(
-                    "UPDATE product_prns SET preview_path = ? WHERE product_id = ? AND stage = ? AND prn_filename = ?",
-                    (preview_full, product_id, stage, filename),
-                )
-                conn.commit()
-            except Exception:
-                logger.exception("Failed to update preview_path in DB after generating preview")
+        _schedule_preview(product_id, stage, filename, save_path)
 
     except sqlite3.IntegrityError as e:
         logger.warning("PRN registration duplicate: %s", e)
@@ -373,11 +879,8 @@ def upload_file():
         logger.exception("Failed to register PRN in DB")
         return jsonify_error("failed to register PRN", 500, e)
 
-    preview_url = None
-    if os.path.exists(os.path.join(product_dir, os.path.splitext(filename)[0] + ".png")):
-        preview_url = f"/preview/{product_name}/{stage}/{filename}"
-
-    return jsonify({"message": "uploaded", "filename": filename, "stage": stage, "saved_path": save_path, "fields": fields, "preview_url": preview_url})
+    # the preview is rendered in the background; it shows up in get-product/list-prns once ready
+    return jsonify({"message": "uploaded", "filename": filename, "stage": stage, "saved_path": save_path, "fields": fields, "preview_url": None})
 
 
 @app.route("/save-fields", methods=["POST"])
@@ -397,8 +900,8 @@ def save_fields():
     If generate_filled is true and source_prn_filename is provided and the file exists, a new PRN will be created by replacing placeholders with the provided values
     and saved as a new PRN record (with preview generated). The response will include preview_url and filled_prn_filename when created.
     """
-    data = request.get_json(force=True, silent=True)
-    if not data or "product_name" not in data or "variables" not in data:
+    data, missing = require_json_fields("product_name", "variables")
+    if data is None or missing:
         return jsonify_error("provide product_name and variables", 400)
     stage = require_stage_from_request(data)
     if not stage:
@@ -410,88 +913,60 @@ def save_fields():
     if not isinstance(variables, dict):
         return jsonify_error("variables must be a JSON object mapping field_name -> value", 400)
 
+    # If requested, generate a filled PRN by replacing placeholders in a source PRN. This only depends on
+    # the request, so it is written before taking the write lock; the transaction below just registers it.
+    filled_fname = filled_path = None
+    if data.get("generate_filled", False) and data.get("source_prn_filename"):
+        product_dir = _product_dir(product_name, stage)
+        src_fname = _secure_filename(data.get("source_prn_filename"))
+        src_path = os.path.join(product_dir, src_fname)
+        if os.path.exists(src_path):
+            try:
+                with open(src_path, "r", encoding="utf-8", errors="ignore") as f:
+                    src_content = f.read()
+                base, ext = os.path.splitext(src_fname)
+                filled_fname = f"{base}_filled_{_unique_suffix()}{ext}"
+                filled_path = os.path.join(product_dir, filled_fname)
+                with open(filled_path, "w", encoding="utf-8", errors="ignore") as out_f:
+                    _write_filled_prn(out_f, src_content, variables)
+            except Exception as e:
+                logger.exception("Failed to generate filled PRN: %s", e)
+                filled_fname = filled_path = None
+
     conn = get_db()
     cur = conn.cursor()
+    filled_info = None
     try:
-        cur.execute("INSERT OR IGNORE INTO products (product_name) VALUES (?)", (product_name,))
-        conn.commit()
-        cur.execute("SELECT id FROM products WHERE product_name = ?", (product_name,))
-        row = cur.fetchone()
-        if not row:
-            return jsonify_error("failed to create or fetch product", 500)
-        product_id = row["id"]
-
-        for field_name, field_value in variables.items():
+        # product, variables and any filled PRN go into one write transaction (a single commit)
+        _begin_write(conn)
+        product_id = _get_or_create_product(cur, product_name)
+
+        cur.executemany(
+            """
+            INSERT INTO variables (product_id, stage, field_name, field_value)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(product_id, stage, field_name) DO UPDATE SET field_value = excluded.field_value
+            """,
+            [(product_id, stage, field_name, field_value) for field_name, field_value in variables.items()],
+        )
+
+        if filled_fname:
+            # register filled prn in DB
             cur.execute(
-                """
-                INSERT INTO variables (product_id, stage, field_name, field_value)
-                VALUES (?, ?, ?, ?)
-                ON CONFLICT(product_id, stage, field_name) DO UPDATE SET field_value = excluded.field_value
-                """,
-                (product_id, stage, field_name, field_value),
+                _SQL_INSERT_PRN,
+                (product_id, stage, filled_fname, filled_path),
             )
-        conn.commit()
-
-        # If requested, generate a filled PRN by replacing placeholders in a source PRN
-        generate_filled = bool(data.get("generate_filled", False))
-        filled_info = None
-        if generate_filled and data.get("source_prn_filename"):
-            safe_product = normalize_product_folder_name(product_name)
-            product_dir = os.path.join(app.config["UPLOAD_FOLDER"], safe_product, stage)
-            src_fname = secure_filename(data.get("source_prn_filename"))
-            src_path = os.path.join(product_dir, src_fname)
-            if os.path.exists(src_path):
-                try:
-                    with open(src_path, "r", encoding="utf-8", errors="ignore") as f:
-                        src_content = f.read()
-                    filled_content = _fill_prn_content(src_content, variables)
-                    base, ext = os.path.splitext(src_fname)
-                    filled_fname = f"{base}_filled_{int(datetime.utcnow().timestamp())}{ext}"
-                    filled_path = os.path.join(product_dir, filled_fname)
-                    with open(filled_path, "w", encoding="utf-8", errors="ignore") as out_f:
-                        out_f.write(filled_content)
-
-                    # register filled prn in DB
-                    try:
-                        cur.execute(
-                            "INSERT INTO product_prns (product_id, stage, prn_filename, prn_path) VALUES (?, ?, ?, ?)",
-                            (product_id, stage, filled_fname, filled_path),
-                        )
-                        conn.commit()
-                    except sqlite3.IntegrityError:
-                        # fallback: if uniqueness somehow conflicts, append timestamp and retry
-                        filled_fname = f"{base}_filled_{int(datetime.utcnow().timestamp())}_{int(datetime.utcnow().timestamp()*1000)}{ext}"
-                        filled_path = os.path.join(product_dir, filled_fname)
-                        with open(filled_path, "w", encoding="utf-8", errors="ignore") as out_f:
-                            out_f.write(filled_content)
-                        cur.execute(
-                            "INSERT INTO product_prns (product_id, stage, prn_filename, prn_path) VALUES (?, ?, ?, ?)",
-                            (product_id, stage, filled_fname, filled_path),
-                        )
-                        conn.commit()
-
-                    # generate preview for filled PRN
-                    preview_fname = os.path.splitext(filled_fname)[0] + ".png"
-                    preview_full = os.path.join(product_dir, preview_fname)
-                    preview_ok = generate_preview(filled_path, preview_full)
-                    if preview_ok:
-                        try:
-                            cur.execute(
-                                "UPDATE product_prns SET preview_path = ? WHERE product_id = ? AND stage = ? AND prn_filename = ?",
-                                (preview_full, product_id, stage, filled_fname),
-                            )
-                            conn.commit()
-                        except Exception:
-                            logger.exception("Failed to update preview_path for filled PRN in DB")
-
-                    filled_info = {"filled_prn_filename": filled_fname, "preview_url": None}
-                    if os.path.exists(preview_full):
-                        filled_info["preview_url"] = f"/preview/{product_name}/{stage}/{filled_fname}"
-                except Exception as e:
-                    logger.exception("Failed to generate filled PRN: %s", e)
+            _schedule_preview(product_id, stage, filled_fname, filled_path)
+            filled_info = {"filled_prn_filename": filled_fname, "preview_url": None}
 
     except Exception as e:
         logger.exception("Failed to save fields")
+        if filled_path:
+            # the PRN row was rolled back with the rest; don't leave its file behind
+            try:
+                os.unlink(filled_path)
+            except OSError:
+                pass
         return jsonify_error("failed to save variable(s)", 500, e)
 
     resp = {"message": "saved/merged", "product_name": product_name, "stage": stage}
@@ -523,35 +998,38 @@ def get_product(product_name):
     conn = get_db()
     cur = conn.cursor()
 
-    cur.execute("SELECT id FROM products WHERE product_name = ?", (product_name,))
-    prod = cur.fetchone()
-    if not prod:
-        cur.execute("INSERT INTO products (product_name) VALUES (?)", (product_name,))
-        conn.commit()
-        cur.execute("SELECT id FROM products WHERE product_name = ?", (product_name,))
-        prod = cur.fetchone()
-    product_id = prod["id"]
+    # plain lookup first so the common (existing product) case stays read-only
+    product_id = _get_product_id(cur, product_name)
+    if product_id is None:
+        _begin_write(conn)
+        product_id = _get_or_create_product(cur, product_name)
 
+    # read everything below from a single snapshot (the write transaction, if one was opened above)
+    if not conn.in_transaction:
+        cur.execute("BEGIN")
     cur.execute("SELECT id, field_name, field_value FROM variables WHERE product_id = ? AND stage = ?", (product_id, stage))
     variables = [
         {"id": r["id"], "field_name": r["field_name"], "field_value": r["field_value"]}
         for r in cur.fetchall()
     ]
 
-    prn_counts = {}
-    for st in ALLOWED_STAGES:
-        cur.execute("SELECT COUNT(1) as cnt FROM product_prns WHERE product_id = ? AND stage = ?", (product_id, st))
-        prn_counts[st] = cur.fetchone()["cnt"]
+    prn_counts = {st: 0 for st in STAGE_ORDER}
+    cur.execute("SELECT stage, COUNT(1) AS cnt FROM product_prns WHERE product_id = ? GROUP BY stage", (product_id,))
+    for r in cur.fetchall():
+        prn_counts[r["stage"]] = r["cnt"]
 
     cur.execute(
-        "SELECT id, prn_filename, prn_path, preview_path, uploaded_at FROM product_prns WHERE product_id = ? AND stage = ? ORDER BY uploaded_at DESC",
+        "SELECT id, prn_filename, preview_path, uploaded_at FROM product_prns WHERE product_id = ? AND stage = ? ORDER BY uploaded_at DESC",
         (product_id, stage),
     )
+    rows = cur.fetchall()
+
     prns = []
-    for r in cur.fetchall():
+    for r in rows:
         preview_url = None
-        if r["preview_path"] and os.path.exists(r["preview_path"]):
-            preview_url = f"/preview/{product_name}/{stage}/{r['prn_filename']}"
+        if r["preview_path"] is not None:
+            # url_for percent-encodes spaces and non-ASCII names and honours SCRIPT_NAME behind a proxy
+            preview_url = url_for("serve_preview", product_name=product_name, stage=stage, filename=r["prn_filename"])
         prns.append(
             {
                 "id": r["id"],
@@ -578,8 +1056,8 @@ def add_variable():
     Add a single variable for a product.
     JSON: { "product_name": "Product A", "stage":"Raw", "field_name":"QTY", "field_value":"10" }
     """
-    data = request.get_json(force=True, silent=True)
-    if not data or "product_name" not in data or "field_name" not in data:
+    data, missing = require_json_fields("product_name", "field_name")
+    if data is None or missing:
         return jsonify_error("product_name and field_name required", 400)
 
     stage = require_stage_from_request(data)
@@ -595,18 +1073,16 @@ def add_variable():
 
     conn = get_db()
     cur = conn.cursor()
-    cur.execute("SELECT id FROM products WHERE product_name = ?", (product_name,))
-    row = cur.fetchone()
-    if not row:
+    product_id = _get_product_id(cur, product_name)
+    if product_id is None:
         return jsonify_error("product not found", 404)
-    product_id = row["id"]
 
     try:
+        _begin_write(conn)
         cur.execute(
             "INSERT INTO variables (product_id, stage, field_name, field_value) VALUES (?, ?, ?, ?)",
             (product_id, stage, field_name, field_value),
         )
-        conn.commit()
     except sqlite3.IntegrityError:
         return jsonify_error("variable already exists for this product+stage", 409)
     except Exception as e:
@@ -621,8 +1097,8 @@ def match_variable_from_db_with_prn():
     Given { product_name, stage (required), prn_content }, check which variables are present in the PRN content.
     Returns mapping field_name -> boolean
     """
-    data = request.get_json(force=True, silent=True)
-    if not data or "product_name" not in data or "prn_content" not in data:
+    data, missing = require_json_fields("product_name", "prn_content")
+    if data is None or missing:
         return jsonify_error("product_name and prn_content required", 400)
 
     stage = require_stage_from_request(data)
@@ -637,19 +1113,25 @@ def match_variable_from_db_with_prn():
 
     conn = get_db()
     cur = conn.cursor()
-    cur.execute("SELECT id FROM products WHERE product_name = ?", (product_name,))
-    row = cur.fetchone()
-    if not row:
+    product_id = _get_product_id(cur, product_name)
+    if product_id is None:
         return jsonify_error("product not found", 404)
-    product_id = row["id"]
 
     cur.execute("SELECT field_name FROM variables WHERE product_id = ? AND stage = ?", (product_id, stage))
     variables = [r["field_name"] for r in cur.fetchall()]
 
-    matched = {}
-    for var in variables:
-        pattern = r"\{" + re.escape(var) + r"\}"
-        matched[var] = bool(re.search(pattern, prn_content))
+    # one pass over the content instead of one regex search per variable,
+    # stopping as soon as every variable has been seen
+    matched = dict.fromkeys(variables, False)
+    remaining = set(variables)
+    if remaining:
+        for m in _BRACED_TOKEN_RE.finditer(prn_content):
+            name = m.group(1)
+            if name in remaining:
+                matched[name] = True
+                remaining.discard(name)
+                if not remaining:
+                    break
 
     return jsonify({"matched_variables": matched, "product_name": product_name, "stage": stage})
 
@@ -661,9 +1143,8 @@ def update_variable():
     JSON: { "product_name": "...", "stage":"Raw", "old_field_name":"OLD", "new_field_name":"NEW", "new_field_value":"...", "generate_filled": true, "source_prn_filename": "optional.prn" }
     If generate_filled is true the server will attempt to create a filled PRN using the provided source_prn_filename (or the most recent template for the product+stage) and return filled_prn_filename and preview_url in the response.
     """
-    data = request.get_json(force=True, silent=True)
-    required = ("product_name" in (data or {}) and "old_field_name" in (data or {}) and ("new_field_name" in (data or {}) or "new_field_value" in (data or {})))
-    if not data or not required:
+    data, missing = require_json_fields("product_name", "old_field_name")
+    if data is None or missing or ("new_field_name" not in data and "new_field_value" not in data):
         return jsonify_error("product_name, old_field_name and (new_field_name or new_field_value) required", 400)
 
     stage = require_stage_from_request(data)
@@ -677,30 +1158,28 @@ def update_variable():
 
     conn = get_db()
     cur = conn.cursor()
-    cur.execute("SELECT id FROM products WHERE product_name = ?", (product_name,))
-    row = cur.fetchone()
-    if not row:
+    product_id = _get_product_id(cur, product_name)
+    if product_id is None:
         return jsonify_error("product not found", 404)
-    product_id = row["id"]
 
-    cur.execute("SELECT id FROM variables WHERE product_id = ? AND stage = ? AND field_name = ?", (product_id, stage, old))
+    cur.execute(_SQL_FIND_VARIABLE, (product_id, stage, old))
     varrow = cur.fetchone()
     if not varrow:
         return jsonify_error("variable not found", 404)
     var_id = varrow["id"]
 
     if new_name != old:
-        cur.execute("SELECT id FROM variables WHERE product_id = ? AND stage = ? AND field_name = ?", (product_id, stage, new_name))
+        cur.execute(_SQL_FIND_VARIABLE, (product_id, stage, new_name))
         if cur.fetchone():
             return jsonify_error("target variable name already exists for this product+stage", 409)
 
     try:
+        _begin_write(conn)
         if new_name != old:
             cur.execute("UPDATE variables SET field_name = ? WHERE id = ?", (new_name, var_id))
 
         if new_value is not None:
             cur.execute("UPDATE variables SET field_value = ? WHERE id = ?", (new_value, var_id))
-        conn.commit()
 
     except Exception as e:
         logger.exception("Error updating variable")
@@ -713,7 +1192,7 @@ def update_variable():
         generate_filled = bool(data.get("generate_filled", False))
         if generate_filled:
             # build variables map for this product+stage from DB
-            cur.execute("SELECT field_name, field_value FROM variables WHERE product_id = ? AND stage = ?", (product_id, stage))
+            cur.execute(_SQL_VARIABLE_VALUES, (product_id, stage))
             variables = {r["field_name"]: r["field_value"] for r in cur.fetchall()}
             # ensure our updated field is reflected
             variables[new_name] = new_value if new_value is not None else variables.get(new_name, "")
@@ -721,65 +1200,38 @@ def update_variable():
             # determine source template PRN
             src_fname = None
             if data.get("source_prn_filename"):
-                src_fname = secure_filename(data.get("source_prn_filename"))
+                src_fname = _secure_filename(data.get("source_prn_filename"))
             else:
                 # pick most recent uploaded PRN for product+stage
-                cur.execute("SELECT prn_filename, prn_path FROM product_prns WHERE product_id = ? AND stage = ? ORDER BY uploaded_at DESC LIMIT 1", (product_id, stage))
+                cur.execute("SELECT prn_filename FROM product_prns WHERE product_id = ? AND stage = ? ORDER BY uploaded_at DESC LIMIT 1", (product_id, stage))
                 r = cur.fetchone()
                 if r:
                     src_fname = r["prn_filename"]
 
             if src_fname:
-                safe_product = normalize_product_folder_name(product_name)
-                product_dir = os.path.join(app.config["UPLOAD_FOLDER"], safe_product, stage)
+                product_dir = _product_dir(product_name, stage)
                 src_path = os.path.join(product_dir, src_fname)
                 if os.path.exists(src_path):
                     try:
                         with open(src_path, "r", encoding="utf-8", errors="ignore") as f:
                             src_content = f.read()
-                        filled_content = _fill_prn_content(src_content, variables)
                         base, ext = os.path.splitext(src_fname)
-                        filled_fname = f"{base}_filled_{int(datetime.utcnow().timestamp())}{ext}"
+                        # one clock read names the file and stamps created_at
+                        now_ns = time.time_ns()
+                        filled_fname = f"{base}_filled_{_unique_suffix(now_ns)}{ext}"
                         filled_path = os.path.join(product_dir, filled_fname)
                         with open(filled_path, "w", encoding="utf-8", errors="ignore") as out_f:
-                            out_f.write(filled_content)
+                            _write_filled_prn(out_f, src_content, variables)
 
                         # register filled prn in DB
-                        try:
-                            cur.execute(
-                                "INSERT INTO product_prns (product_id, stage, prn_filename, prn_path) VALUES (?, ?, ?, ?)",
-                                (product_id, stage, filled_fname, filled_path),
-                            )
-                            conn.commit()
-                        except sqlite3.IntegrityError:
-                            filled_fname = f"{base}_filled_{int(datetime.utcnow().timestamp())}_{int(datetime.utcnow().timestamp()*1000)}{ext}"
-                            filled_path = os.path.join(product_dir, filled_fname)
-                            with open(filled_path, "w", encoding="utf-8", errors="ignore") as out_f:
-                                out_f.write(filled_content)
-                            cur.execute(
-                                "INSERT INTO product_prns (product_id, stage, prn_filename, prn_path) VALUES (?, ?, ?, ?)",
-                                (product_id, stage, filled_fname, filled_path),
-                            )
-                            conn.commit()
-
-                        # generate preview for filled PRN
-                        preview_fname = os.path.splitext(filled_fname)[0] + ".png"
-                        preview_full = os.path.join(product_dir, preview_fname)
-                        preview_ok = generate_preview(filled_path, preview_full)
-                        if preview_ok:
-                            try:
-                                cur.execute(
-                                    "UPDATE product_prns SET preview_path = ? WHERE product_id = ? AND stage = ? AND prn_filename = ?",
-                                    (preview_full, product_id, stage, filled_fname),
-                                )
-                                conn.commit()
-                            except Exception:
-                                logger.exception("Failed to update preview_path for filled PRN in DB after update-variable generation")
+                        cur.execute(
+                            _SQL_INSERT_PRN,
+                            (product_id, stage, filled_fname, filled_path),
+                        )
 
+                        _schedule_preview(product_id, stage, filled_fname, filled_path)
                         response.update({"filled_prn_filename": filled_fname, "preview_url": None})
-                        if os.path.exists(preview_full):
-                            response["preview_url"] = f"/preview/{product_name}/{stage}/{filled_fname}"
-                            response["created_at"] = datetime.utcnow().isoformat()
+                        response["created_at"] = _utc_isoformat(now_ns)
                     except Exception as e:
                         logger.exception("Failed to create filled PRN after variable update: %s", e)
                         # fall through without failing the whole request
@@ -799,8 +1251,8 @@ def delete_variable():
     Delete a variable. Requires stage context.
     JSON: { "product_name":"...", "stage":"Raw", "field_name":"..." }
     """
-    data = request.get_json(force=True, silent=True)
-    if not data or "product_name" not in data or "field_name" not in data:
+    data, missing = require_json_fields("product_name", "field_name")
+    if data is None or missing:
         return jsonify_error("product_name and field_name required", 400)
 
     stage = require_stage_from_request(data)
@@ -812,19 +1264,20 @@ def delete_variable():
 
     conn = get_db()
     cur = conn.cursor()
-    cur.execute("SELECT id FROM products WHERE product_name = ?", (product_name,))
-    row = cur.fetchone()
-    if not row:
+    product_id = _get_product_id(cur, product_name)
+    if product_id is None:
         return jsonify_error("product not found", 404)
-    product_id = row["id"]
 
+    _begin_write(conn)
     cur.execute("DELETE FROM variables WHERE product_id = ? AND stage = ? AND field_name = ?", (product_id, stage, field_name))
     if cur.rowcount == 0:
         return jsonify_error("variable not found for this product+stage", 404)
-    conn.commit()
     return jsonify({"message": "variable deleted", "field_name": field_name, "product_name": product_name, "stage": stage})
 
 
+_LIST_PRNS_KEYS = ("id", "prn_filename", "prn_path", "preview_path", "uploaded_at")
+
+
 @app.route("/list-prns/<path:product_name>/<path:stage>", methods=["GET"])
 def list_prns(product_name, stage):
     st = stage_folder_name(stage)
@@ -832,23 +1285,14 @@ def list_prns(product_name, stage):
         return jsonify_error("invalid stage", 400)
     conn = get_db()
     cur = conn.cursor()
-    cur.execute("SELECT id FROM products WHERE product_name = ?", (product_name,))
-    prod = cur.fetchone()
-    if not prod:
+    pid = _get_product_id(cur, product_name)
+    if pid is None:
         return jsonify([])
-    pid = prod["id"]
-    cur.execute("SELECT id, prn_filename, prn_path, preview_path, uploaded_at FROM product_prns WHERE product_id = ? AND stage = ? ORDER BY uploaded_at DESC", (pid, st))
-    rows = cur.fetchall()
-    res = [
-        {
-            "id": r["id"],
-            "prn_filename": r["prn_filename"],
-            "prn_path": r["prn_path"],
-            "preview_path": r["preview_path"],
-            "uploaded_at": r["uploaded_at"],
-        }
-        for r in rows
-    ]
+    # plain tuples zipped with the column names, instead of a Row lookup per field
+    rows_cur = conn.cursor()
+    rows_cur.row_factory = None
+    rows_cur.execute("SELECT id, prn_filename, prn_path, preview_path, uploaded_at FROM product_prns WHERE product_id = ? AND stage = ? ORDER BY uploaded_at DESC", (pid, st))
+    res = [dict(zip(_LIST_PRNS_KEYS, r)) for r in rows_cur]
     return jsonify(res)
 
 
@@ -860,20 +1304,18 @@ def get_prn(product_name, stage, filename):
         return jsonify_error("invalid stage", 400)
     conn = get_db()
     cur = conn.cursor()
-    cur.execute("SELECT id FROM products WHERE product_name = ?", (product_name,))
-    prod = cur.fetchone()
-    if not prod:
+    pid = _get_product_id(cur, product_name)
+    if pid is None:
         return jsonify_error("product not found", 404)
-    pid = prod["id"]
-    fname = secure_filename(filename)
+    fname = _secure_filename(filename)
     cur.execute("SELECT prn_path FROM product_prns WHERE product_id = ? AND stage = ? AND prn_filename = ?", (pid, st, fname))
     r = cur.fetchone()
     if not r:
         return jsonify_error("prn not found", 404)
-    path = r["prn_path"]
-    if not os.path.exists(path):
+    try:
+        return send_upload(r["prn_path"], one_shot=True, as_attachment=True)
+    except FileNotFoundError:
         return jsonify_error("file missing on disk", 404)
-    return send_file(path, as_attachment=True)
 
 
 @app.route("/preview/<path:product_name>/<path:stage>/<path:filename>", methods=["GET"])
@@ -884,24 +1326,24 @@ def serve_preview(product_name, stage, filename):
         return jsonify_error("invalid stage", 400)
     conn = get_db()
     cur = conn.cursor()
-    cur.execute("SELECT id FROM products WHERE product_name = ?", (product_name,))
-    prod = cur.fetchone()
-    if not prod:
+    pid = _get_product_id(cur, product_name)
+    if pid is None:
         return jsonify_error("product not found", 404)
-    pid = prod["id"]
-    fname = secure_filename(filename)
+    fname = _secure_filename(filename)
     cur.execute("SELECT preview_path FROM product_prns WHERE product_id = ? AND stage = ? AND prn_filename = ?", (pid, st, fname))
     r = cur.fetchone()
     if not r or not r["preview_path"]:
         return jsonify_error("preview not available", 404)
     preview_path = r["preview_path"]
-    if not os.path.exists(preview_path):
-        return jsonify_error("preview file missing", 404)
 
     # support ?download=1 to force download/attachment
     download_flag = (request.args.get("download") or "").lower() in ("1", "true", "yes")
     try:
-        return send_file(preview_path, mimetype="image/png", as_attachment=download_flag)
+        # the ETag is size + mtime (previews are rewritten via os.replace), so a matching
+        # If-None-Match gets a 304 with no body
+        return send_upload(preview_path, mimetype="image/png", as_attachment=download_flag, max_age=PREVIEW_MAX_AGE)
+    except FileNotFoundError:
+        return jsonify_error("preview file missing", 404)
     except Exception as e:
         logger.exception("Error sending preview file: %s", e)
         return jsonify_error("failed to send preview", 500, e)
@@ -913,27 +1355,24 @@ def delete_prn():
     Delete a PRN record and remove the files.
     JSON body required: { "product_name": "...", "stage": "Raw|SFG|FG", "prn_filename": "file.prn" }
     """
-    data = request.get_json(force=True, silent=True)
+    data, missing = require_json_fields("product_name", "stage", "prn_filename")
     if not data:
         return jsonify_error("invalid json body", 400)
-    for k in ("product_name", "stage", "prn_filename"):
-        if k not in data:
-            return jsonify_error(f"{k} required", 400)
+    if missing:
+        return jsonify_error(f"{missing} required", 400)
 
     st = stage_folder_name(data["stage"])
     if not st:
         return jsonify_error("invalid stage", 400)
 
     pname = str(data["product_name"]).strip()
-    fname = secure_filename(data["prn_filename"])
+    fname = _secure_filename(data["prn_filename"])
 
     conn = get_db()
     cur = conn.cursor()
-    cur.execute("SELECT id FROM products WHERE product_name = ?", (pname,))
-    prod = cur.fetchone()
-    if not prod:
+    pid = _get_product_id(cur, pname)
+    if pid is None:
         return jsonify_error("product not found", 404)
-    pid = prod["id"]
 
     cur.execute("SELECT id, prn_path, preview_path FROM product_prns WHERE product_id = ? AND stage = ? AND prn_filename = ?", (pid, st, fname))
     r = cur.fetchone()
@@ -943,17 +1382,23 @@ def delete_prn():
     prn_path = r["prn_path"]
     preview_path = r["preview_path"]
 
+    _begin_write(conn)
     cur.execute("DELETE FROM product_prns WHERE id = ?", (prn_id,))
-    conn.commit()
 
-    # best-effort file removal, do not fail the API if file deletion fails
-    try:
-        if prn_path and os.path.exists(prn_path):
-            os.remove(prn_path)
-        if preview_path and os.path.exists(preview_path):
-            os.remove(preview_path)
-    except Exception as e:
-        logger.warning("Error removing files during delete-prn: %s", e)
+    # the PRN is removed inside the transaction, so if it cannot be removed the error
+    # response rolls the DELETE back
+    if prn_path:
+        try:
+            os.unlink(prn_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("Error removing PRN file during delete-prn: %s", e)
+            return jsonify_error("failed to remove PRN file", 500, e)
+    # the preview is only removed once the DELETE has committed, so a failed commit never leaves
+    # a row whose preview_path points at a missing PNG; a leftover PNG is only logged
+    if preview_path:
+        _unlink_after_commit(preview_path)
 
     return jsonify({"message": "deleted", "prn_filename": fname})
 
@@ -964,17 +1409,26 @@ def download(filename):
     Backwards compatible convenience endpoint that searches the uploads tree.
     Prefer using /get-prn/<product>/<stage>/<filename>.
     """
-    filename = secure_filename(filename)
+    filename = _secure_filename(filename)
     # check immediate uploads root
     file_path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-    if os.path.exists(file_path):
-        return send_file(file_path, as_attachment=True)
-    # search tree
-    for root, dirs, files in os.walk(app.config["UPLOAD_FOLDER"]):
-        if filename in files:
-            return send_file(os.path.join(root, filename), as_attachment=True)
-    abort(404)
+    try:
+        return send_upload(file_path, one_shot=True, as_attachment=True)
+    except FileNotFoundError:
+        pass
+    # every stored PRN is registered, so look it up instead of walking the tree
+    cur = get_db().cursor()
+    cur.execute("SELECT prn_path FROM product_prns WHERE prn_filename = ? ORDER BY uploaded_at DESC LIMIT 1", (filename,))
+    r = cur.fetchone()
+    if not r:
+        abort(404)
+    try:
+        return send_upload(r["prn_path"], one_shot=True, as_attachment=True)
+    except FileNotFoundError:
+        abort(404)
 
 if __name__ == "__main__":
     logger.info("Starting PRN Manager on 0.0.0.0:5001")
-    app.run(host="0.0.0.0", port=5001, debug=True)
+    # development server only; set FLASK_DEBUG=1 for the debugger/reloader.
+    # In production run: gunicorn -c gunicorn_conf.py app:app
+    app.run(host="0.0.0.0", port=5001)
@@ -0,0 +1,13 @@
+# gunicorn -c gunicorn_conf.py app:app
+import multiprocessing
+
+bind = "0.0.0.0:5001"
+
+# requests mostly wait on SQLite, the disk or Labelary, so each worker serves several at once on threads
+workers = multiprocessing.cpu_count() * 2 + 1
+worker_class = "gthread"
+threads = 8
+
+# not preloaded: importing app opens a pooled SQLite connection, and connections (and the
+# preview/checkpoint threads) must not be shared across fork, so each worker imports it itself
+preload_app = False